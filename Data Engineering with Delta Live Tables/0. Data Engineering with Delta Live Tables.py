@@ -14,6 +14,8 @@
 # MAGIC - Create a Unity Catalog volume to hold your files
 # MAGIC - Create a Unity Catalog schema for any tables you create
 # MAGIC - Generate some simulated financial data
+# MAGIC
+# MAGIC The setup script uses the Spark context directly, so run it on classic compute with the single user (dedicated) access mode. It will not run on serverless or shared access mode compute.
 
 # COMMAND ----------
 
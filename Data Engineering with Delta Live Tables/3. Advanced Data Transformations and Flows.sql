@@ -45,22 +45,20 @@ FROM STREAM read_files(
 
 -- MAGIC %md
 -- MAGIC ### Backfilling Historical Data
--- MAGIC Analysts and data scientists are often interested in datasets with several years of historical data. When building new data pipelines, data engineers must consider how to backfill data with minimal impact to the incremental ingestion. In the next cell, we'll ingest some historical order data and insert it into our `b_orders` table using a one-time flow.
+-- MAGIC Analysts and data scientists are often interested in datasets with several years of historical data. When building new data pipelines, data engineers must consider how to backfill data with minimal impact to the incremental ingestion. In the next cell, we'll ingest some historical order data and insert it into our `b_orders` table using a one-time flow. Because the backlog is much larger than our daily order files, it has been exported as Parquet rather than CSV; `read_files(...)` only needs a different `format`.
 
 -- COMMAND ----------
 
 CREATE FLOW b_orders_history
 COMMENT 
-  "Historical order data from csv files; Processed incrementally"
+  "Historical order data from parquet files; Processed incrementally"
 AS INSERT INTO 
   b_orders BY NAME
 SELECT
   *
 FROM STREAM read_files(
   '/Volumes/dlt_workshop_gregory_hansen_databricks_com/finance/_files/orders_backlog',
-  format => 'csv',
-  header => true,
-  mode => 'PERMISSIVE'
+  format => 'parquet'
 )
 
 -- COMMAND ----------
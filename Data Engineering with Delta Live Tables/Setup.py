@@ -5,9 +5,18 @@
 # COMMAND ----------
 
 import dbldatagen as dg
+import glob
+import numpy as np
+import os
+import pandas as pd
 import re
+import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from faker import Faker
-from faker.providers import address, company, lorem, phone_number
+from pyspark import StorageLevel, inheritable_thread_target
+from pyspark.sql.functions import array, col, element_at, lit, pandas_udf, rand, when
+from pyspark.sql.types import StringType
 
 # COMMAND ----------
 
@@ -24,130 +33,237 @@ spark.sql(f'''
 
 # COMMAND ----------
 
-def initFaker(context):
-  context.faker = Faker(locale='en_US')
-  context.faker.add_provider(address)
-  context.faker.add_provider(company)
-  context.faker.add_provider(lorem)
-  context.faker.add_provider(phone_number)
+PAYMENT_TERMS = ['DUE_ON_RECEIPT', 'NET_30', 'NET_60', 'NET_90', 'NET_120']
+UPDATE_TYPES = ['INSERT', 'UPDATE', 'DELETE']
+BUSINESS_UNITS = ['retail', 'wholesale']
 
-name_generator = (lambda context, v: context.faker.company())
-address_generator = (lambda context, v: context.faker.address())
-phone_generator = (lambda context, v: context.faker.phone_number())
-desc_generator = (lambda context, v: context.faker.sentence())
+# Bump when the generated data changes so outputs from older setups are rewritten
+SETUP_VERSION = '1'
 
-customers_generator = (
-  dg.DataGenerator(rows=100)
-    .withIdOutput()
-    .withColumn('customer_name', 'string', percentNulls=0.01, text=dg.PyfuncText(name_generator, init=initFaker))
-    .withColumn('billing_address', 'string', percentNulls=0.01, text=dg.PyfuncText(address_generator, init=initFaker))
-    .withColumn('mailing_address', 'string', percentNulls=0.2, text=dg.PyfuncText(address_generator, init=initFaker))
-    .withColumn('phone_number', 'string', percentNulls=0.2, text=dg.PyfuncText(phone_generator, init=initFaker))
-    .withColumn('email', 'string', percentNulls=0.1, expr='concat(replace(initcap(regexp_replace(customer_name, "[^0-9A-Za-z]", " ")), " ", ""), "@example.com")')
-    .withColumn('payment_terms', 'string', values=['DUE_ON_RECEIPT', 'NET_30', 'NET_60', 'NET_90', 'NET_120'], random=True)
-    .withColumn('balance_limit', 'decimal(10,2)', percentNulls=0.01, min=1000, max=100000, random=True)
-)
+CUSTOMERS_ROWS = 100
+SUPPLIERS_CDC_ROWS = 20
+ITEMS_ROWS = 1000
+ORDERS_NEW_ROWS = 1000
+ORDERS_ROWS = 10000
+ORDERS_BACKLOG_ROWS = 100000
 
-suppliers_cdc_generator = (
-  dg.DataGenerator(rows=20)
-    .withColumn('update_type', 'string', values=['INSERT', 'UPDATE', 'DELETE'], random=True)
-    .withColumn('update_date', 'timestamp', minValue='2024-01-01 00:00:00', maxValue='2024-12-31 11:59:59', random=True)
-    .withColumn('id', 'integer', minValue=1, maxValue=100, random=True)
-    .withColumn('supplier_name', 'string', percentNulls=0.01, text=dg.PyfuncText(name_generator, init=initFaker))
-    .withColumn('billing_address', 'string', percentNulls=0.01, text=dg.PyfuncText(address_generator, init=initFaker))
-    .withColumn('mailing_address', 'string', percentNulls=0.2, text=dg.PyfuncText(address_generator, init=initFaker))
-    .withColumn('phone_number', 'string', percentNulls=0.2, text=dg.PyfuncText(phone_generator, init=initFaker))
-    .withColumn('email', 'string', percentNulls=0.1, expr='concat(replace(initcap(regexp_replace(supplier_name, "[^0-9A-Za-z]", " ")), " ", ""), "@example.com")')
-)
+# Fixed so the random columns do not depend on the cluster's default parallelism
+ORDERS_PARTITIONS = 8
 
-items_generator = (
-  dg.DataGenerator(rows=1000)
-    .withIdOutput()
-    .withColumn('description', 'string', percentNulls=0.1, text=dg.PyfuncText(desc_generator, init=initFaker))
-    .withColumn('unit_price', 'decimal(10,2)', percentNulls=0.01, min=1, max=500, step=0.01, random=True)
-)
+NULL_RATES = {
+  'customer_name': 0.01,
+  'supplier_name': 0.01,
+  'billing_address': 0.01,
+  'mailing_address': 0.2,
+  'phone_number': 0.2,
+  'email': 0.1,
+  'balance_limit': 0.01,
+  'description': 0.1,
+  'unit_price': 0.01
+}
+
+_FAKER = Faker(locale='en_US')
+
+@pandas_udf(StringType())
+def fake_sentence(ids: pd.Series) -> pd.Series:
+  fake = _FAKER_BC.value
+  if len(ids):
+    fake.seed_instance(int(ids.iloc[0]))
+  return pd.Series([fake.sentence() for _ in range(len(ids))])
+
+def with_nulls(df):
+  return df.select(*[
+    when(rand(zlib.crc32(column.encode())) < NULL_RATES[column], lit(None)).otherwise(col(column)).alias(column) if column in NULL_RATES else col(column)
+    for column in df.columns
+  ])
+
+def pick(values, index_column):
+  return element_at(array(*[lit(v) for v in values]), col(index_column) + 1)
 
 orders_generator = (
-  dg.DataGenerator(rows=10000)
+  dg.DataGenerator(rows=ORDERS_NEW_ROWS + ORDERS_ROWS + ORDERS_BACKLOG_ROWS, partitions=ORDERS_PARTITIONS, randomSeed=42)
     .withIdOutput()
-    .withColumn('order_date', 'timestamp', minValue='2020-01-01 00:00:00', maxValue='2024-01-01 00:00:00', random=True)
-    .withColumn('description', 'string', percentNulls=0.1, text=dg.PyfuncText(desc_generator, init=initFaker))
+    .withColumn('recent_order_date', 'timestamp', minValue='2020-01-01 00:00:00', maxValue='2024-01-01 00:00:00', random=True, omit=True)
+    .withColumn('backlog_order_date', 'timestamp', minValue='2000-01-01 00:00:00', maxValue='2020-01-01 00:00:00', random=True, omit=True)
+    .withColumn('order_date', 'timestamp', baseColumn=['id', 'recent_order_date', 'backlog_order_date'], expr=f'if(id < {ORDERS_NEW_ROWS + ORDERS_ROWS}, recent_order_date, backlog_order_date)')
     .withColumn('customer_id', 'integer', minValue=1, maxValue=100, random=True)
     .withColumn('item_id', 'integer', minValue=1, maxValue=1000, random=True)
-    .withColumn('qty_ordered', 'integer', minValue=1, maxValue=100, random=True)
-    .withColumn('business_unit', 'string', values=['retail', 'wholesale'], random=True)
+    .withColumn('qty_ordered', 'integer', baseColumn='id', expr="pmod(hash(id, 'qty_ordered'), 100) + 1")
+    .withColumn('business_unit_idx', 'int', baseColumn='id', expr=f"pmod(hash(id, 'business_unit'), {len(BUSINESS_UNITS)})")
 )
 
-orders_new_generator = (
-  dg.DataGenerator(rows=1000)
-    .withIdOutput()
-    .withColumn('order_date', 'timestamp', minValue='2020-01-01 00:00:00', maxValue='2024-01-01 00:00:00', random=True)
-    .withColumn('description', 'string', percentNulls=0.1, text=dg.PyfuncText(desc_generator, init=initFaker))
-    .withColumn('customer_id', 'integer', minValue=1, maxValue=100, random=True)
-    .withColumn('item_id', 'integer', minValue=1, maxValue=1000, random=True)
-    .withColumn('qty_ordered', 'integer', minValue=1, maxValue=100, random=True)
-    .withColumn('business_unit', 'string', values=['direct_to_consumer'])
-)
+# COMMAND ----------
 
-orders_backlog_generator = orders_generator.withRowCount(100000) \
-  .withColumn('order_date', 'timestamp', minValue='2000-01-01 00:00:00', maxValue='2020-01-01 00:00:00', random=True)
+def mask_nulls(rng, values, column):
+  values = pd.Series(values)
+  return values.mask(rng.random(len(values)) < NULL_RATES[column])
 
-# COMMAND ----------
+_EMAIL_NONWORD = re.compile(r'[^0-9A-Za-z]')
 
-customers_generator.build() \
-  .write \
-  .format('csv') \
-  .option('header', 'true') \
-  .option('sep', '|') \
-  .mode('overwrite') \
-  .save(f'/Volumes/dlt_workshop_{username}/finance/_files/customers')
+def to_email(names: pd.Series) -> pd.Series:
+  return names.str.replace(_EMAIL_NONWORD, ' ', regex=True).str.title().str.replace(' ', '', regex=False) + '@example.com'
 
-# COMMAND ----------
+def entity_columns(rng, rows, name_column):
+  names = mask_nulls(rng, [_FAKER.company() for _ in range(rows)], name_column)
+  return {
+    name_column: names,
+    'billing_address': mask_nulls(rng, [_FAKER.address() for _ in range(rows)], 'billing_address'),
+    'mailing_address': mask_nulls(rng, [_FAKER.address() for _ in range(rows)], 'mailing_address'),
+    'phone_number': mask_nulls(rng, [_FAKER.phone_number() for _ in range(rows)], 'phone_number'),
+    'email': mask_nulls(rng, to_email(names), 'email')
+  }
 
-suppliers_cdc_generator.build() \
-  .write \
-  .format('csv') \
-  .option('header', 'true') \
-  .option('sep', ',') \
-  .mode('overwrite') \
-  .save(f'/Volumes/dlt_workshop_{username}/finance/_files/suppliers_cdc')
+def build_customers(rng, rows):
+  return pd.DataFrame({
+    'id': np.arange(rows),
+    **entity_columns(rng, rows, 'customer_name'),
+    'payment_terms': rng.choice(PAYMENT_TERMS, rows),
+    'balance_limit': mask_nulls(rng, rng.integers(1000, 100001, rows).astype(float), 'balance_limit')
+  })
 
-# COMMAND ----------
+def build_suppliers_cdc(rng, rows):
+  update_start = np.datetime64('2024-01-01T00:00:00')
+  update_seconds = int((np.datetime64('2024-12-31T11:59:59') - update_start) / np.timedelta64(1, 's'))
+  return pd.DataFrame({
+    'update_type': rng.choice(UPDATE_TYPES, rows),
+    'update_date': update_start + rng.integers(0, update_seconds + 1, rows).astype('timedelta64[s]'),
+    'id': rng.integers(1, 101, rows),
+    **entity_columns(rng, rows, 'supplier_name')
+  })
 
-items_generator.build() \
-  .write \
-  .format('csv') \
-  .option('header', 'true') \
-  .option('sep', ',') \
-  .mode('overwrite') \
-  .save(f'/Volumes/dlt_workshop_{username}/finance/_files/items')
+def build_items(rng, rows):
+  return pd.DataFrame({
+    'id': np.arange(rows),
+    'description': mask_nulls(rng, [_FAKER.sentence() for _ in range(rows)], 'description'),
+    'unit_price': mask_nulls(rng, rng.integers(100, 50001, rows) / 100, 'unit_price')
+  })
 
 # COMMAND ----------
 
-orders_generator.build() \
-  .write \
-  .format('csv') \
-  .option('header', 'true') \
-  .option('sep', ',') \
-  .mode('overwrite') \
-  .save(f'/Volumes/dlt_workshop_{username}/finance/_files/orders')
+def files_path(path):
+  return f'/Volumes/dlt_workshop_{username}/finance/_files/{path}'
 
-# COMMAND ----------
+def setup_version(output_path):
+  try:
+    with open(f'{output_path}/_SETUP_VERSION') as f:
+      return f.read().strip()
+  except FileNotFoundError:
+    return None
+
+def stamp_setup_version(output_path):
+  with open(f'{output_path}/_SETUP_VERSION', 'w') as f:
+    f.write(SETUP_VERSION)
+
+def local_output_is_current(path, sep, rows):
+  output_path = files_path(path)
+  if setup_version(output_path) != SETUP_VERSION:
+    return False
+  files = glob.glob(f'{output_path}/part-*.csv')
+  try:
+    return len(files) == 1 and len(pd.read_csv(files[0], sep=sep)) == rows
+  except (pd.errors.EmptyDataError, pd.errors.ParserError):
+    return False
+
+def write_local_dataset(build, path, sep, rows, seed):
+  if local_output_is_current(path, sep, rows):
+    return
+  rng = np.random.default_rng(seed)
+  _FAKER.seed_instance(seed)
+  df = build(rng, rows)
+  output_path = files_path(path)
+  shutil.rmtree(output_path, ignore_errors=True)
+  os.makedirs(output_path)
+  # Versioned file name so Auto Loader picks up regenerated files in existing pipelines
+  df.to_csv(f'{output_path}/part-00000-v{SETUP_VERSION}.csv', sep=sep, index=False, float_format='%.2f', date_format='%Y-%m-%dT%H:%M:%S')
+  stamp_setup_version(output_path)
+
+def output_is_current(output):
+  output_path = files_path(output['path'])
+  if setup_version(output_path) != SETUP_VERSION:
+    return False
+  return spark.read.format(output['format']).options(**output['format_options']).load(output_path).count() == output['rows']
 
-orders_new_generator.build() \
-  .write \
-  .format('csv') \
-  .option('header', 'true') \
-  .option('sep', ',') \
-  .mode('overwrite') \
-  .save(f'/Volumes/dlt_workshop_{username}/finance/_files/orders_new')
+def write_dataset(df, output):
+  spark.sparkContext.setLocalProperty('spark.scheduler.pool', output['path'])
+  if 'cluster_by' in output:
+    df = df.repartitionByRange(output['partitions'], output['cluster_by']).sortWithinPartitions(output['cluster_by'])
+  else:
+    df = df.repartition(output['partitions'])
+  output_path = files_path(output['path'])
+  df.write \
+    .format(output['format']) \
+    .options(**output['format_options'], **output['write_options']) \
+    .mode('overwrite') \
+    .save(output_path)
+  stamp_setup_version(output_path)
+
+write_local_dataset(build_customers, path='customers', sep='|', rows=CUSTOMERS_ROWS, seed=42)
+write_local_dataset(build_suppliers_cdc, path='suppliers_cdc', sep=',', rows=SUPPLIERS_CDC_ROWS, seed=43)
+write_local_dataset(build_items, path='items', sep=',', rows=ITEMS_ROWS, seed=44)
 
 # COMMAND ----------
 
-orders_backlog_generator.build() \
-  .write \
-  .format('csv') \
-  .option('header', 'true') \
-  .option('sep', ',') \
-  .mode('overwrite') \
-  .save(f'/Volumes/dlt_workshop_{username}/finance/_files/orders_backlog')
+orders_outputs = [
+  {
+    'path': 'orders',
+    'rows': ORDERS_ROWS,
+    'format': 'csv',
+    'format_options': {'header': 'true', 'sep': ','},
+    'write_options': {},
+    'partitions': 1
+  },
+  {
+    'path': 'orders_new',
+    'rows': ORDERS_NEW_ROWS,
+    'format': 'csv',
+    'format_options': {'header': 'true', 'sep': ','},
+    'write_options': {},
+    'partitions': 1
+  },
+  {
+    'path': 'orders_backlog',
+    'rows': ORDERS_BACKLOG_ROWS,
+    'format': 'parquet',
+    'format_options': {},
+    'write_options': {'compression': 'snappy'},
+    'partitions': 2,
+    'cluster_by': 'order_date'
+  }
+]
+
+pending = [output for output in orders_outputs if not output_is_current(output)]
+
+if pending:
+  # Requires spark.sparkContext (classic compute in single user (dedicated) access mode, not serverless or shared access)
+  _FAKER_BC = spark.sparkContext.broadcast(_FAKER)
+
+  orders_all = orders_generator.build() \
+    .withColumn('_tag', when(col('id') < ORDERS_NEW_ROWS, lit('orders_new')).when(col('id') < ORDERS_NEW_ROWS + ORDERS_ROWS, lit('orders')).otherwise(lit('orders_backlog'))) \
+    .withColumn('business_unit', pick(BUSINESS_UNITS, 'business_unit_idx')) \
+    .drop('business_unit_idx') \
+    .withColumn('description', fake_sentence(col('id'))) \
+    .transform(with_nulls) \
+    .select('id', 'order_date', 'description', 'customer_id', 'item_id', 'qty_ordered', 'business_unit', '_tag') \
+    .persist(StorageLevel.DISK_ONLY)
+
+  orders_frames = {
+    'orders': orders_all.filter("_tag = 'orders'")
+      .drop('_tag')
+      .withColumn('id', col('id') - ORDERS_NEW_ROWS),
+    'orders_new': orders_all.filter("_tag = 'orders_new'")
+      .drop('_tag')
+      .withColumn('business_unit', lit('direct_to_consumer')),
+    'orders_backlog': orders_all.filter("_tag = 'orders_backlog'")
+      .drop('_tag')
+      .withColumn('id', (col('id') - (ORDERS_NEW_ROWS + ORDERS_ROWS)).cast('integer'))
+  }
+
+  try:
+    orders_all.count()
+
+    with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+      futures = [executor.submit(inheritable_thread_target(write_dataset), orders_frames[output['path']], output) for output in pending]
+      for future in futures:
+        future.result()
+  finally:
+    orders_all.unpersist()